@@ -0,0 +1,105 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter, Histogram
+
+### SETTINGS
+# Лимиты действуют на процесс: при WEB_CONCURRENCY > 1 суммарный лимит умножается на число процессов
+DB_READ_CONCURRENCY = int(os.getenv("DB_READ_CONCURRENCY", "6"))
+DB_WRITE_CONCURRENCY = int(os.getenv("DB_WRITE_CONCURRENCY", "4"))
+HASH_SERVICE_CONCURRENCY = int(os.getenv("HASH_SERVICE_CONCURRENCY", "20"))
+BROKER_PUBLISH_CONCURRENCY = int(os.getenv("BROKER_PUBLISH_CONCURRENCY", "4"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))  # Сколько запросов может ждать слот
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1.0"))  # Дедлайн ожидания слота, сек
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))  # Значение заголовка Retry-After при 503
+CREATE_POST_RATE = float(os.getenv("CREATE_POST_RATE", "5"))  # Токенов в секунду на клиента
+CREATE_POST_BURST = float(os.getenv("CREATE_POST_BURST", "10"))  # Ёмкость корзины на клиента
+
+QUEUE_WAIT = Histogram("admission_queue_wait_seconds", "Time spent waiting for a dependency slot", ["dependency"])
+SHED = Counter("admission_shed_total", "Requests rejected by admission control", ["dependency", "reason"])
+
+
+class Overloaded(Exception):
+    """ Запрос отклонён из-за перегрузки зависимости или лимита клиента. """
+
+    def __init__(self, dependency: str, retry_after: int, status_code: int = 503):
+        super().__init__(f"{dependency} is overloaded")
+        self.dependency = dependency
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class ConcurrencyLimiter:
+    """ Ограничение одновременных обращений к зависимости с ограниченной очередью и дедлайном ожидания. """
+
+    def __init__(self, dependency: str, limit: int, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.dependency = dependency
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self._waiting = 0
+
+    async def __aenter__(self) -> None:
+        # Очередь полна: отказываем сразу, не дожидаясь дедлайна
+        if self._semaphore.locked() and self._waiting >= self.queue_size:
+            SHED.labels(dependency=self.dependency, reason="queue_full").inc()
+            raise Overloaded(self.dependency, RETRY_AFTER)
+
+        self._waiting += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            SHED.labels(dependency=self.dependency, reason="deadline").inc()
+            raise Overloaded(self.dependency, RETRY_AFTER)
+        finally:
+            self._waiting -= 1
+            QUEUE_WAIT.labels(dependency=self.dependency).observe(time.perf_counter() - started)
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._semaphore.release()
+
+
+class TokenBucket:
+    """ Корзина токенов на каждого клиента. Хранит не больше max_clients корзин (вытесняются самые старые). """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def take(self, client: str) -> float:
+        """ Забрать токен. Возвращает 0, если токен выдан, иначе через сколько секунд будет следующий. """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+db_read_limit = ConcurrencyLimiter("db_read", DB_READ_CONCURRENCY)
+db_write_limit = ConcurrencyLimiter("db_write", DB_WRITE_CONCURRENCY)
+hash_service_limit = ConcurrencyLimiter("hash_service", HASH_SERVICE_CONCURRENCY)
+broker_publish_limit = ConcurrencyLimiter("broker_publish", BROKER_PUBLISH_CONCURRENCY)
+create_post_bucket = TokenBucket(CREATE_POST_RATE, CREATE_POST_BURST)
+
+
+def check_create_post_rate(client: str) -> None:
+    """ Лимит /create_post на клиента. При превышении - 429 с Retry-After. """
+    wait = create_post_bucket.take(client)
+    if wait > 0:
+        SHED.labels(dependency="create_post", reason="rate_limited").inc()
+        raise Overloaded("create_post", math.ceil(wait), status_code=429)
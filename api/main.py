@@ -1,24 +1,37 @@
+import asyncio
+import os
 import time
 from os import getenv
 
-from prometheus_client import generate_latest, REGISTRY
+from prometheus_client import generate_latest, multiprocess, CollectorRegistry, Gauge, REGISTRY
 import aiohttp
-from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import RedirectResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from pydantic import BaseModel, Field
 from redis.asyncio import Redis
 
-from database import create_tables, ensure_db_ready, ensure_redis_ready, create_database, store_in_db, get_post_db
+from admission import Overloaded, RETRY_AFTER, SHED, hash_service_limit, check_create_post_rate
+from database import ensure_redis_ready, init_db_pool, close_db_pool, store_in_db, get_post_db
 from logging_config import log_request, logger
+from tracing import (TRACEPARENT_HEADER, span, current_traceparent, recent_spans, check_debug_token,
+                     sample_profile, dropped_span_count)
 
 
 ### SETTINGS
+IMPORT_TIME = time.monotonic()  # Запасной отсчёт, если /proc недоступен (без старта интерпретатора и импортов)
 app = FastAPI()
 
 REDIS_URL_TEXT = getenv('REDIS_URL_TEXT', default="redis://172.18.0.3/0")
 redis = Redis.from_url(REDIS_URL_TEXT, decode_responses=True)
 
 HASH_SERVICE_URL = getenv('HASH_SERVICE_URL', default="http://hash-service:8002/generate-hash")
+HASH_SERVICE_TIMEOUT = float(getenv('HASH_SERVICE_TIMEOUT', default="2"))
+http_session: aiohttp.ClientSession | None = None  # Общая сессия с пулом соединений к hash-service на процесс
+
+# В multiprocess-режиме отдаём самый долгий холодный старт среди процессов
+STARTUP_DURATION = Gauge("service_startup_seconds", "Cold start time of the process until it is ready",
+                         multiprocess_mode="max")
+startup_seconds: float | None = None  # Заполняется, когда процесс готов принимать запросы
 
 
 ### Pydantic Models
@@ -32,19 +45,35 @@ class CreatePostResponse(BaseModel):
 
 
 ### UTILS
+def process_uptime() -> float:
+    """ Время с запуска процесса, включая старт интерпретатора и импорты (по /proc/self/stat). """
+    try:
+        with open("/proc/self/stat") as f:
+            # Поля после имени процесса начинаются с 3-го, starttime - 22-е поле, в тиках с загрузки системы
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - IMPORT_TIME
+
+
 async def store_in_redis_or_db(short_hash: str, text: str, ttl: int) -> None:
     """Сохранение текста в Redis (если TTL короткий) или в БД."""
     # logger.debug(f"Storing text with hash={short_hash}, ttl={ttl}")
     if ttl <= 3600:  # Если TTL <= 1 час
         try:
-            await redis.set(short_hash, text, ex=ttl)
-            logger.info(f"Text stored in REDIS with hash={short_hash}")
+            with span("redis.set", key=short_hash):
+                await redis.set(short_hash, text, ex=ttl)
+            logger.info("Text stored in REDIS with hash=%s", short_hash)
         except Exception as e:
             logger.error(f"Error storing text in REDIS: {e}")
     else:
         try:
             await store_in_db(short_hash, text, ttl)
-            logger.info(f"Text stored in DATABASE with hash={short_hash}")
+            logger.info("Text stored in DATABASE with hash=%s", short_hash)
+        except Overloaded:
+            raise
         except Exception as e:
             logger.error(f"Error storing text in DATABASE: {e}")
 
@@ -52,23 +81,59 @@ async def store_in_redis_or_db(short_hash: str, text: str, ttl: int) -> None:
 ### ENDPOINTS
 @app.on_event("startup")
 async def on_startup() -> None:
-    """ Инициализация при старте приложения. """
+    """
+    Быстрый старт процесса: только пул соединений и Redis.
+    Создание БД и таблиц вынесено в migrate.py и выполняется один раз до запуска процессов.
+    """
     logger.debug("Starting application initialization.")
+    global redis, http_session, startup_seconds
+    # Сессия создаётся до шагов, которые могут упасть: /create_post не должен остаться без неё
+    # Размер пула соединений совпадает с лимитом одновременных вызовов hash-service
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=hash_service_limit.limit),
+        timeout=aiohttp.ClientTimeout(total=HASH_SERVICE_TIMEOUT),
+    )
+
     try:
-        # Убедитесь, что база данных доступна
-        await create_database()
-        logger.info("Database created successfully.")
-        await ensure_db_ready()
-        logger.info("Database is ready.")
-        await create_tables()
-        logger.info("Tables are created.")
+        # Пул открывает DB_POOL_MIN_SIZE соединений сразу, первые запросы не ждут подключения
+        await init_db_pool()
+        logger.info("Database pool is ready.")
 
         # Убедитесь, что Redis доступен
-        global redis
         redis = await ensure_redis_ready(REDIS_URL_TEXT)
         logger.info("Redis is ready.")
+
+        startup_seconds = process_uptime()
+        STARTUP_DURATION.set(startup_seconds)
+        logger.info(f"Application ready in {startup_seconds:.3f}s.")
     except Exception as e:
+        # Процесс без пула не восстановится сам: падаем, compose перезапустит контейнер
         logger.error(f"Error in startup app: {e}")
+        raise
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    """ Освобождение соединений при остановке процесса. """
+    await close_db_pool()
+    await redis.close()
+    if http_session is not None:
+        await http_session.close()
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded) -> Response:
+    """ Быстрый отказ при перегрузке: 503 (или 429 для лимита клиента) с Retry-After. """
+    return JSONResponse(
+        {"detail": f"Service overloaded: {exc.dependency}"},
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+async def create_post_rate_limit(request: Request) -> None:
+    """ Зависимость /create_post: корзина токенов на IP клиента. """
+    check_create_post_rate(request.client.host if request.client else "unknown")
 
 
 @app.middleware("http")
@@ -76,7 +141,12 @@ async def log_requests(request: Request, call_next) -> Response:
     """ Middleware для логирования запросов и измерения их времени. """
     # logger.debug(f"Processing request: {request.method} {request.url}")
     start_time = time.time()
-    response = await call_next(request)
+    with span(request.method, request.headers.get(TRACEPARENT_HEADER), path=request.url.path) as request_span:
+        response = await call_next(request)
+        # Имя спана по шаблону маршрута (/get/{short_hash}), иначе у каждого поста было бы своё имя
+        route = request.scope.get("route")
+        request_span.name = f"{request.method} {route.path if route else request.url.path}"
+        request_span.attributes["status_code"] = response.status_code
     response_time = time.time() - start_time
 
     # Логируем и добавляем метрики
@@ -89,7 +159,41 @@ async def log_requests(request: Request, call_next) -> Response:
 @app.get("/metrics")
 async def metrics() -> Response:
     """ Эндпоинт для отдачи метрик в формате, который Prometheus может собрать. """
-    return Response(generate_latest(REGISTRY), media_type="text/plain")
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Несколько процессов uvicorn: собираем метрики всех процессов, а не только ответившего
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type="text/plain")
+
+
+@app.get("/ready")
+async def readiness() -> Response:
+    """ Готовность процесса: пул БД и Redis прогреты. 503, пока старт не завершён. """
+    if startup_seconds is None:
+        return JSONResponse({"status": "starting"}, status_code=503)
+    return JSONResponse({"status": "ready", "startup_seconds": startup_seconds})
+
+
+@app.get("/debug/traces")
+async def debug_traces(trace_id: str | None = None, x_debug_token: str | None = Header(None)) -> dict:
+    """ Последние спаны из локального буфера. Доступ только с X-Debug-Token. """
+    if not check_debug_token(x_debug_token):
+        raise HTTPException(status_code=404, detail="Not found")
+    return {"spans": recent_spans(trace_id), "dropped_spans": dropped_span_count()}
+
+
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def debug_profile(seconds: float = 10, x_debug_token: str | None = Header(None)) -> str:
+    """ Сэмплирующий профайлер на N секунд. Возвращает стеки в collapsed-формате для flame graph. """
+    if not check_debug_token(x_debug_token):
+        raise HTTPException(status_code=404, detail="Not found")
+    # Сэмплирование в отдельном потоке, чтобы event loop продолжал обслуживать запросы
+    profile = await asyncio.to_thread(sample_profile, seconds)
+    if profile is None:
+        raise HTTPException(status_code=409, detail="Profiling already in progress")
+    return profile
 
 
 @app.get("/")
@@ -98,20 +202,34 @@ async def root():
     return RedirectResponse(url="/docs")
 
 
-@app.post("/create_post", response_model=CreatePostResponse)
+@app.post("/create_post", response_model=CreatePostResponse, dependencies=[Depends(create_post_rate_limit)])
 async def create_post(request: CreatePostRequest) -> dict:
     """ Создание публикации. Возвращает ссылку на пост в формате: {"short_url": short_url} """
     # logger.debug(f"Received create_post request: {request}")
     try:
         # Генерация уникального хэша
-        async with aiohttp.ClientSession() as session:
-            async with session.get(HASH_SERVICE_URL) as response:
-                if response.status != 200:
-                    error_detail = await response.text()
-                    logger.error(f"Hash service error: {error_detail}")
-                    raise HTTPException(status_code=response.status, detail=f"Error from hash service: {error_detail}")
-                data = await response.json()
-                short_hash = data['hash']
+        async with hash_service_limit:
+            with span("hash_service.generate_hash", url=HASH_SERVICE_URL):
+                traceparent = current_traceparent()
+                headers = {TRACEPARENT_HEADER: traceparent} if traceparent else {}
+                try:
+                    async with http_session.get(HASH_SERVICE_URL, headers=headers) as response:
+                        if response.status >= 500:
+                            # hash-service перегружен или упал: быстрый 503 с Retry-After вместо 500
+                            SHED.labels(dependency="hash_service", reason="unavailable").inc()
+                            raise Overloaded("hash_service", RETRY_AFTER)
+                        if response.status != 200:
+                            error_detail = await response.text()
+                            logger.error(f"Hash service error: {error_detail}")
+                            raise HTTPException(status_code=response.status, detail=f"Error from hash service: {error_detail}")
+                        data = await response.json()
+                        short_hash = data['hash']
+                except asyncio.TimeoutError:
+                    SHED.labels(dependency="hash_service", reason="timeout").inc()
+                    raise Overloaded("hash_service", RETRY_AFTER)
+                except aiohttp.ClientConnectionError:
+                    SHED.labels(dependency="hash_service", reason="unavailable").inc()
+                    raise Overloaded("hash_service", RETRY_AFTER)
                 # logger.debug(f"Hash generated: {short_hash}")
 
         # Сохранение в Redis или БД
@@ -122,6 +240,8 @@ async def create_post(request: CreatePostRequest) -> dict:
         # logger.debug(f"Short URL created: {short_url}")
 
         return {"short_url": short_url}
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Error in create_post: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -133,7 +253,8 @@ async def get_post(short_hash: str) -> dict:
     # logger.debug(f"Received get_post request for hash={short_hash}")
     try:
         # Сначала пытаемся получить текст из Redis
-        text = await redis.get(short_hash)
+        with span("redis.get", key=short_hash):
+            text = await redis.get(short_hash)
 
         if not text:
             # logger.debug(f"Hash {short_hash} not found in Redis, checking database.")
@@ -144,8 +265,9 @@ async def get_post(short_hash: str) -> dict:
                 # logger.debug(f"Hash {short_hash} found in database.")
 
                 # Кэшируем текст в Redis (redis_text)
-                await redis.set(short_hash, text, ex=600)  # TTL = 600 секунд
-                logger.info(f"Hash {short_hash} cached in Redis with TTL=600s.")
+                with span("redis.set", key=short_hash):
+                    await redis.set(short_hash, text, ex=600)  # TTL = 600 секунд
+                logger.info("Hash %s cached in Redis with TTL=600s.", short_hash)
             else:
                 logger.warning(f"Hash {short_hash} not found in database.")
                 raise HTTPException(status_code=404, detail="Post not found")
@@ -155,6 +277,8 @@ async def get_post(short_hash: str) -> dict:
             pass
 
         return {"text": text}
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Error in get_post: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -0,0 +1,18 @@
+import asyncio
+
+from database import create_database, ensure_db_ready, create_tables
+from logging_config import logger
+
+
+async def migrate() -> None:
+    """ Разовая подготовка схемы (БД и таблицы). Запускается один раз перед стартом процессов api-service. """
+    await create_database()
+    logger.info("Database created successfully.")
+    await ensure_db_ready()
+    logger.info("Database is ready.")
+    await create_tables()
+    logger.info("Tables are created.")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -3,16 +3,19 @@ import time
 
 import asyncio
 import base64
-from fastapi import FastAPI, Request, Response
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from redis.asyncio import Redis
-from prometheus_client import generate_latest, REGISTRY
+from prometheus_client import generate_latest, multiprocess, CollectorRegistry, Gauge, REGISTRY
 
 from logging_config import logger, log_request
-from database import fetch_batch_sequences, create_database, check_and_create_sequence
+from tracing import (TRACEPARENT_HEADER, span, recent_spans, check_debug_token, sample_profile,
+                     dropped_span_count)
+from database import fetch_batch_sequences, init_db_pool, close_db_pool
 
 
 ### SETTINGS
+IMPORT_TIME = time.monotonic()  # Запасной отсчёт, если /proc недоступен (без старта интерпретатора и импортов)
 app = FastAPI()
 
 REDIS_URL = os.getenv('REDIS_URL_HASH', default="redis://172.18.0.2/0")
@@ -25,8 +28,27 @@ BATCH_SIZE = 1000
 LOCK_TIMEOUT = 10 * 1000  # 10 секунд в миллисекундах
 MAX_RETRIES = 5  # Максимальное количество попыток
 
+# В multiprocess-режиме отдаём самый долгий холодный старт среди процессов
+STARTUP_DURATION = Gauge("service_startup_seconds", "Cold start time of the process until it is ready",
+                         multiprocess_mode="max")
+startup_seconds: float | None = None  # Заполняется, когда процесс готов принимать запросы
+background_tasks = set()  # Ссылки на фоновые задачи, чтобы их не собрал GC
+
 
 ### UTILS
+def process_uptime() -> float:
+    """ Время с запуска процесса, включая старт интерпретатора и импорты (по /proc/self/stat). """
+    try:
+        with open("/proc/self/stat") as f:
+            # Поля после имени процесса начинаются с 3-го, starttime - 22-е поле, в тиках с загрузки системы
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - IMPORT_TIME
+
+
 def generate_hash(seq: int) -> str:
     """ Генерация 8-значного хэша из числа """
     return base64.urlsafe_b64encode(seq.to_bytes(6, byteorder="big")).decode("utf-8")[:8]
@@ -51,7 +73,8 @@ async def acquire_lock(redis_client, lock_key, lock_timeout):
     # logger.debug('Blocks Redis')
     lock_value = str(time.time())  # Уникальное значение для блокировки
     try:
-        is_set = await redis_client.set(lock_key, lock_value, nx=True, px=lock_timeout)
+        with span("redis.acquire_lock", key=lock_key):
+            is_set = await redis_client.set(lock_key, lock_value, nx=True, px=lock_timeout)
         return is_set, lock_value
     except Exception as e:
         logger.error(f"Error acquiring Redis lock: {e}")
@@ -62,9 +85,10 @@ async def release_lock(redis_client, lock_key, lock_value) -> None:
     """ Освобождение блокировки Redis """
     # logger.debug('Releasing the Redis lock')
     try:
-        current_value = await redis_client.get(lock_key)
-        if current_value == lock_value:
-            await redis_client.delete(lock_key)  # Удаляем блокировку
+        with span("redis.release_lock", key=lock_key):
+            current_value = await redis_client.get(lock_key)
+            if current_value == lock_value:
+                await redis_client.delete(lock_key)  # Удаляем блокировку
     except Exception as e:
         logger.error(f"Error releasing Redis lock: {e}")
 
@@ -78,13 +102,16 @@ async def populate_redis_cache() -> None:
         return
 
     try:
-        current_count = await redis_client.llen(REDIS_HASH_KEY)
+        with span("redis.llen", key=REDIS_HASH_KEY):
+            current_count = await redis_client.llen(REDIS_HASH_KEY)
         if current_count >= BATCH_SIZE:
             return  # Уже достаточно ключей
 
-        sequences = await retry_on_error(lambda: fetch_batch_sequences(BATCH_SIZE))
+        with span("postgres.fetch_batch_sequences", batch_size=BATCH_SIZE):
+            sequences = await retry_on_error(lambda: fetch_batch_sequences(BATCH_SIZE))
         hashes = [generate_hash(seq) for seq in sequences]
-        await retry_on_error(lambda: redis_client.lpush(REDIS_HASH_KEY, *hashes))
+        with span("redis.lpush", key=REDIS_HASH_KEY, count=len(hashes)):
+            await retry_on_error(lambda: redis_client.lpush(REDIS_HASH_KEY, *hashes))
         # logger.debug(f"Added {len(hashes)} hashes to Redis.")
     except Exception as e:
         logger.error(f"Error populating Redis cache: {e}")
@@ -96,13 +123,41 @@ async def ensure_redis_cache() -> None:
     """ Проверка кеша и автоматическое пополнение """
     # logger.debug('Cache check and automatic refill')
     try:
-        current_count = await redis_client.llen(REDIS_HASH_KEY)
+        with span("redis.llen", key=REDIS_HASH_KEY):
+            current_count = await redis_client.llen(REDIS_HASH_KEY)
         if current_count < CRITICAL_THRESHOLD:
             await populate_redis_cache()
     except Exception as e:
         logger.error(f"Error ensuring Redis cache: {e}")
 
 
+async def wait_until_warm() -> None:
+    """ Ждёт, пока в кеше появятся хэши, и только тогда отмечает процесс готовым. """
+    global startup_seconds
+    while True:
+        try:
+            # Процесс, проигравший блокировку, не наполняет кеш сам, поэтому проверяем фактический размер
+            await asyncio.wait_for(ensure_redis_cache(), timeout=10)
+            with span("redis.llen", key=REDIS_HASH_KEY):
+                if await redis_client.llen(REDIS_HASH_KEY) > 0:
+                    break
+        except Exception as e:
+            logger.warning(f"Hash cache is not warm yet: {e!r}")
+        await asyncio.sleep(1)
+
+    startup_seconds = process_uptime()
+    STARTUP_DURATION.set(startup_seconds)
+    logger.info(f"Application ready in {startup_seconds:.3f}s.")
+
+
+def start_background_task(coro) -> asyncio.Task:
+    """ Запуск фоновой задачи с сохранением ссылки на неё. """
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
 async def ensure_redis_cache_periodically() -> None:
     """ Фоновая задача для проверки кеша с ограничением времени ожидания """
     logger.debug('Background task for cache check with timeout limit')
@@ -120,21 +175,32 @@ async def ensure_redis_cache_periodically() -> None:
 ### ENDPOINTS
 @app.on_event("startup")
 async def startup() -> None:
-    """ Инициализация приложения """
+    """
+    Быстрый старт процесса: пул соединений и прогрев кеша хэшей.
+    Создание БД и последовательности вынесено в migrate.py и выполняется один раз до запуска процессов.
+    """
     # logger.debug('Startup')
     try:
-        await create_database()
-        logger.info("Checked and created database..")
-        await check_and_create_sequence()
-        logger.info("Checked and created sequence.")
-
-        # Запуск фоновой задачи для периодической проверки кеша
-        asyncio.create_task(ensure_redis_cache_periodically())  # Запуск фоновой задачи
-        logger.info("Background task for cache checking started.")
-
-        logger.info("Application started successfully.")
+        await init_db_pool()
+        logger.info("Database pool is ready.")
     except Exception as e:
+        # Процесс без пула не восстановится сам: падаем, compose перезапустит контейнер
         logger.error(f"Failed to start application: {e}")
+        raise
+
+    # Запуск фоновой задачи для периодической проверки кеша
+    start_background_task(ensure_redis_cache_periodically())
+    logger.info("Background task for cache checking started.")
+
+    # Прогрев кеша в фоне, startup не ждёт: /ready отдаёт 503, пока хэши в кеше действительно не появятся
+    start_background_task(wait_until_warm())
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    """ Освобождение соединений при остановке процесса. """
+    await close_db_pool()
+    await redis_client.close()
 
 
 @app.middleware("http")
@@ -142,7 +208,12 @@ async def log_requests(request: Request, call_next) -> Request:
     """ Middleware для логирования запросов и измерения их времени. """
     # logger.debug(f"Processing request: {request.method} {request.url}")
     start_time = time.time()
-    response = await call_next(request)
+    with span(request.method, request.headers.get(TRACEPARENT_HEADER), path=request.url.path) as request_span:
+        response = await call_next(request)
+        # Имя спана по шаблону маршрута (/get/{short_hash}), иначе у каждого поста было бы своё имя
+        route = request.scope.get("route")
+        request_span.name = f"{request.method} {route.path if route else request.url.path}"
+        request_span.attributes["status_code"] = response.status_code
     response_time = time.time() - start_time
 
     # Логируем и добавляем метрики
@@ -155,7 +226,41 @@ async def log_requests(request: Request, call_next) -> Request:
 @app.get("/metrics")
 async def metrics() -> Response:
     """ Эндпоинт для отдачи метрик в формате, который Prometheus может собрать. """
-    return Response(generate_latest(REGISTRY), media_type="text/plain")
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Несколько процессов uvicorn: собираем метрики всех процессов, а не только ответившего
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type="text/plain")
+
+
+@app.get("/ready")
+async def readiness() -> Response:
+    """ Готовность процесса: пул БД открыт, кеш хэшей прогрет. 503, пока старт не завершён. """
+    if startup_seconds is None:
+        return JSONResponse({"status": "starting"}, status_code=503)
+    return JSONResponse({"status": "ready", "startup_seconds": startup_seconds})
+
+
+@app.get("/debug/traces")
+async def debug_traces(trace_id: str | None = None, x_debug_token: str | None = Header(None)) -> dict:
+    """ Последние спаны из локального буфера. Доступ только с X-Debug-Token. """
+    if not check_debug_token(x_debug_token):
+        raise HTTPException(status_code=404, detail="Not found")
+    return {"spans": recent_spans(trace_id), "dropped_spans": dropped_span_count()}
+
+
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def debug_profile(seconds: float = 10, x_debug_token: str | None = Header(None)) -> str:
+    """ Сэмплирующий профайлер на N секунд. Возвращает стеки в collapsed-формате для flame graph. """
+    if not check_debug_token(x_debug_token):
+        raise HTTPException(status_code=404, detail="Not found")
+    # Сэмплирование в отдельном потоке, чтобы event loop продолжал обслуживать запросы
+    profile = await asyncio.to_thread(sample_profile, seconds)
+    if profile is None:
+        raise HTTPException(status_code=409, detail="Profiling already in progress")
+    return profile
 
 
 @app.get("/")
@@ -172,13 +277,15 @@ async def get_hash():
         await ensure_redis_cache()
 
         # Попытка извлечь из Redis
-        hash_value = await redis_client.rpop(REDIS_HASH_KEY)
+        with span("redis.rpop", key=REDIS_HASH_KEY):
+            hash_value = await redis_client.rpop(REDIS_HASH_KEY)
         if hash_value:
             return {"hash": hash_value}
 
         # Fallback на базу данных
         logger.info("Redis is empty. Generating hash directly from the database.")
-        sequences = await retry_on_error(lambda: fetch_batch_sequences(1))
+        with span("postgres.fetch_batch_sequences", batch_size=1):
+            sequences = await retry_on_error(lambda: fetch_batch_sequences(1))
         return {"hash": generate_hash(sequences[0])}
     except Exception as e:
         logger.error(f"Failed to generate hash: {e}")
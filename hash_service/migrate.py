@@ -0,0 +1,16 @@
+import asyncio
+
+from database import create_database, check_and_create_sequence
+from logging_config import logger
+
+
+async def migrate() -> None:
+    """ Разовая подготовка схемы (БД и последовательность). Запускается один раз перед стартом процессов hash-service. """
+    await create_database()
+    logger.info("Checked and created database..")
+    await check_and_create_sequence()
+    logger.info("Checked and created sequence.")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
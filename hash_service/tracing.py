@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+### SETTINGS
+SERVICE_NAME = os.getenv("SERVICE_NAME", "hash-service")
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "2048"))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")  # Например /tmp/spans.jsonl, по умолчанию только память
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", "10000"))  # Спаны сверх очереди отбрасываются
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")  # Без токена отладочные эндпоинты выключены
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = 0.005  # 5 мс между снимками стеков
+
+TRACEPARENT_HEADER = "traceparent"
+
+_current_span = ContextVar("current_span", default=None)
+_finished_spans = deque(maxlen=TRACE_RING_SIZE)
+_export_queue = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+_export_file = None  # Открывается при импорте, None - экспорт в файл выключен
+dropped_spans = 0  # Спаны, не записанные в файл (очередь полна или ошибка записи)
+_profile_lock = threading.Lock()
+
+
+class Span:
+    """ Один замер операции внутри трейса. """
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def traceparent(self) -> str:
+        """ Заголовок W3C traceparent для передачи контекста дальше. """
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> dict:
+        return {
+            "service": SERVICE_NAME,
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+### UTILS
+def parse_traceparent(header: str | None) -> tuple[str, str] | None:
+    """ Разбор заголовка traceparent в пару (trace_id, span_id). """
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+def current_trace_id() -> str | None:
+    """ trace_id текущего спана (для привязки логов к трейсу). """
+    current = _current_span.get()
+    return current.trace_id if current else None
+
+
+def current_traceparent() -> str | None:
+    """ traceparent текущего спана (для HTTP-заголовков и сообщений брокера). """
+    current = _current_span.get()
+    return current.traceparent() if current else None
+
+
+@contextmanager
+def span(name: str, traceparent: str | None = None, **attributes):
+    """ Спан вокруг операции. Родитель берётся из контекста или из traceparent. """
+    parent = _current_span.get()
+    if parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+        remote = parse_traceparent(traceparent)
+        trace_id, parent_id = remote if remote else (secrets.token_hex(16), None)
+
+    current = Span(name, trace_id, parent_id, attributes)
+    token = _current_span.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current_span.reset(token)
+        _export(current)
+
+
+def _export(finished: Span) -> None:
+    """ Экспорт спана в кольцевой буфер и, если задан, в файл. """
+    global dropped_spans
+    record = finished.to_dict()
+    _finished_spans.append(record)
+    if _export_file is not None:
+        try:
+            _export_queue.put_nowait(record)
+        except queue.Full:
+            dropped_spans += 1
+
+
+def _file_exporter() -> None:
+    """ Фоновая запись спанов в файл, чтобы не писать на диск из event loop. """
+    global dropped_spans
+    while True:
+        record = _export_queue.get()
+        try:
+            _export_file.write(json.dumps(record) + "\n")
+            if _export_queue.empty():
+                _export_file.flush()
+        except OSError:
+            dropped_spans += 1
+
+
+if TRACE_EXPORT_FILE:
+    try:
+        _export_file = open(TRACE_EXPORT_FILE, "a", encoding="utf-8")
+    except OSError as e:
+        logging.getLogger("uvicorn").error(f"Span file export disabled, cannot open {TRACE_EXPORT_FILE}: {e}")
+    else:
+        threading.Thread(target=_file_exporter, name="span-exporter", daemon=True).start()
+
+
+def recent_spans(trace_id: str | None = None) -> list[dict]:
+    """ Последние завершённые спаны, опционально по одному трейсу. """
+    spans = list(_finished_spans)
+    if trace_id:
+        spans = [s for s in spans if s["trace_id"] == trace_id]
+    return spans
+
+
+def dropped_span_count() -> int:
+    """ Сколько спанов не попало в файл экспорта. """
+    return dropped_spans
+
+
+def check_debug_token(token: str | None) -> bool:
+    """ Проверка доступа к отладочным эндпоинтам. """
+    if not DEBUG_TOKEN or token is None:
+        return False
+    # Сравниваем байты: compare_digest на str падает на не-ASCII, а заголовки декодируются как latin-1
+    return secrets.compare_digest(token.encode(), DEBUG_TOKEN.encode())
+
+
+def sample_profile(seconds: float) -> str | None:
+    """
+    Сэмплирующий профайлер: снимает стеки всех потоков в течение seconds.
+    Возвращает стеки в collapsed-формате (flamegraph.pl / speedscope) или None, если профилирование уже идёт.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(PROFILE_INTERVAL)
+        return "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+    finally:
+        _profile_lock.release()
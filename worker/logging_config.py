@@ -1,12 +1,128 @@
+import atexit
+import copy
+import json
 import logging
+import os
+import queue
 import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
 
-# Настройка логгера для FastAPI
-logger = logging.getLogger("uvicorn")
-logger.setLevel(logging.INFO)
+from tracing import SERVICE_NAME, current_trace_id
+
+### SETTINGS
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Записи сверх очереди отбрасываются, а не блокируют
+LOG_INFO_RATE = int(os.getenv("LOG_INFO_RATE", "50"))  # Записей INFO/DEBUG в секунду с одного места вызова, 0 - без лимита
+LOG_DROP_REPORT_INTERVAL = int(os.getenv("LOG_DROP_REPORT_INTERVAL", "10"))  # Не чаще раза в N секунд пишем об отброшенных
+
+dropped_records = {"queue_full": 0, "rate_limited": 0}  # Всего с запуска, Prometheus в воркере нет
+unreported_drops = {"queue_full": 0, "rate_limited": 0}  # Отброшено с момента последнего отчёта в лог
+
+
+def count_dropped(reason: str) -> None:
+    """ Учёт отброшенной записи: для метрики и для периодического отчёта в лог. """
+    unreported_drops[reason] += 1
+    dropped_records[reason] += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """ Запись лога в виде одной JSON-строки. """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "service": SERVICE_NAME,
+            "message": record.getMessage(),
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """ Пропускает не больше rate записей INFO и ниже в секунду с одного места вызова. WARNING и выше - всегда. """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self._windows: dict[tuple[str, int], tuple[int, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(time.monotonic())
+        window, count = self._windows.get(key, (second, 0))
+        if window != second:
+            window, count = second, 0
+        if count >= self.rate:
+            count_dropped("rate_limited")
+            return False
+        self._windows[key] = (window, count + 1)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ Передаёт записи фоновому потоку. При полной очереди запись отбрасывается, вызывающий код не ждёт. """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self._last_report = time.monotonic()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Здесь только собираем сообщение и trace_id (он есть лишь в потоке запроса), JSON - уже в фоновом потоке
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.trace_id = current_trace_id()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            count_dropped("queue_full")
+            return
+        if any(unreported_drops.values()) and time.monotonic() - self._last_report >= LOG_DROP_REPORT_INTERVAL:
+            self._report_dropped()
+
+    def _report_dropped(self) -> None:
+        """ Сообщение о числе отброшенных записей (полная очередь и лимит INFO), когда в очереди снова есть место. """
+        reported = dict(unreported_drops)
+        counts = ", ".join(f"{reason}={count}" for reason, count in reported.items())
+        report = logging.LogRecord(logger.name, logging.WARNING, __file__, 0,
+                                   f"Log records dropped: {counts}", None, None)
+        try:
+            self.queue.put_nowait(report)
+        except queue.Full:
+            return
+        self._last_report = time.monotonic()
+        for reason, count in reported.items():
+            unreported_drops[reason] -= count
+
+
+# Настройка логгера: запись в stdout делает фоновый поток, обработчик сообщений только кладёт запись в очередь
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(log_queue)
+queue_handler.addFilter(RateLimitFilter(LOG_INFO_RATE))
 console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-logger.addHandler(console_handler)
+console_handler.setFormatter(JsonFormatter())
+log_listener = QueueListener(log_queue, console_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Дописываем оставшиеся записи при остановке
+
+logger = logging.getLogger("worker")  # Воркер - консьюмер pika, не процесс uvicorn
+logger.setLevel(logging.INFO)
+logger.handlers = [queue_handler]  # Только через очередь, без синхронной записи в stdout
+logger.propagate = False
 
 # Логирование запросов и метрик
 def log_request(request, response_time, status_code):
@@ -15,6 +131,3 @@ def log_request(request, response_time, status_code):
 
     # Логируем информацию о запросе
     # logger.info(f"Request to {request.url} completed with status {status_code}")
-
-
-
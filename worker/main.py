@@ -5,7 +5,13 @@ import pika
 import json
 import asyncio
 import asyncpg
-import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+from logging_config import logger, dropped_records
+from tracing import (TRACEPARENT_HEADER, DEBUG_TOKEN, span, recent_spans, check_debug_token, sample_profile,
+                     dropped_span_count)
 
 # Настройки из переменных окружения
 DATABASE_URL = os.getenv("DATABASE_URL_TEXT")
@@ -13,10 +19,7 @@ RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 EXCHANGE_NAME = os.getenv("EXCHANGE_NAME", "delayed_exchange")
 credentials = pika.PlainCredentials('user', 'password') # todo: Получать из енв
 connection_params = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials)
-
-# Настройка логгера
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+DEBUG_PORT = int(os.getenv("DEBUG_PORT", "8003"))
 
 
 async def delete_from_db(hash_value: str) -> None:
@@ -25,10 +28,12 @@ async def delete_from_db(hash_value: str) -> None:
     try:
         # Подключаемся к базе данных
         # logger.debug(f"Connecting to database with URL: {DATABASE_URL}")
-        conn = await asyncpg.connect(DATABASE_URL)
+        with span("postgres.connect"):
+            conn = await asyncpg.connect(DATABASE_URL)
 
         # Выполняем запрос на удаление данных
-        await conn.execute("DELETE FROM posts WHERE hash = $1", hash_value)
+        with span("postgres.delete_post", key=hash_value):
+            await conn.execute("DELETE FROM posts WHERE hash = $1", hash_value)
         # logger.info(f"Successfully deleted data with hash: {hash_value}")
 
     except Exception as e:
@@ -41,6 +46,13 @@ async def delete_from_db(hash_value: str) -> None:
 
 def process_message(ch, method, properties, body) -> None:
     """ Обработчик сообщений из RabbitMQ """
+    # Продолжаем трейс, начатый в api-service при публикации сообщения
+    traceparent = (properties.headers or {}).get(TRACEPARENT_HEADER)
+    with span("rabbitmq.process_message", traceparent, routing_key=method.routing_key):
+        _process_message(ch, method, body)
+
+
+def _process_message(ch, method, body) -> None:
     try:
         message = json.loads(body)
         hash_to_delete = message.get("hash")
@@ -55,7 +67,7 @@ def process_message(ch, method, properties, body) -> None:
 
         # Подтверждение обработки сообщения
         ch.basic_ack(delivery_tag=method.delivery_tag)
-        logger.info(f"Message with hash {hash_to_delete} processed successfully.")
+        logger.info("Message with hash %s processed successfully.", hash_to_delete)
 
     except json.JSONDecodeError as e:
         logger.error(f"Error decoding JSON message: {e}")
@@ -65,7 +77,54 @@ def process_message(ch, method, properties, body) -> None:
         ch.basic_nack(delivery_tag=method.delivery_tag)
 
 
+class DebugHandler(BaseHTTPRequestHandler):
+    """ Отладочные эндпоинты воркера: /debug/traces, /debug/logs и /debug/profile?seconds=N. Доступ только с X-Debug-Token. """
+
+    def do_GET(self) -> None:
+        if not check_debug_token(self.headers.get("X-Debug-Token")):
+            return self._reply(404, "application/json", json.dumps({"detail": "Not found"}))
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/debug/traces":
+            trace_id = query.get("trace_id", [None])[0]
+            return self._reply(200, "application/json", json.dumps({"spans": recent_spans(trace_id), "dropped_spans": dropped_span_count()}))
+        if url.path == "/debug/logs":
+            return self._reply(200, "application/json", json.dumps({"dropped_records": dropped_records}))
+        if url.path == "/debug/profile":
+            try:
+                seconds = float(query.get("seconds", ["10"])[0])
+            except ValueError:
+                return self._reply(422, "application/json", json.dumps({"detail": "Invalid seconds"}))
+            profile = sample_profile(seconds)
+            if profile is None:
+                return self._reply(409, "application/json", json.dumps({"detail": "Profiling already in progress"}))
+            return self._reply(200, "text/plain", profile)
+        return self._reply(404, "application/json", json.dumps({"detail": "Not found"}))
+
+    def _reply(self, status: int, content_type: str, body: str) -> None:
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args) -> None:
+        pass  # Не засоряем лог воркера запросами к отладочным эндпоинтам
+
+
+def start_debug_server() -> None:
+    """ Запуск отладочного HTTP-сервера в фоновом потоке, только если задан DEBUG_TOKEN. """
+    if not DEBUG_TOKEN:
+        return
+    server = ThreadingHTTPServer(("0.0.0.0", DEBUG_PORT), DebugHandler)
+    Thread(target=server.serve_forever, name="debug-server", daemon=True).start()
+    logger.info(f"Debug server started on port {DEBUG_PORT}.")
+
+
 def main():
+    start_debug_server()
     try:
         # Настройка RabbitMQ соединения
         # logger.debug(f"Connecting to RabbitMQ at {RABBITMQ_HOST}...")